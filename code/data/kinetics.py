@@ -38,6 +38,8 @@ class Kinetics400(VisionDataset):
         step_between_clips (int): number of frames between each clip
         transform (callable, optional): A function/transform that  takes in a TxHxWxC video
             and returns a transformed version.
+        num_workers (int): number of subprocesses used to read the video metadata (frame
+            timestamps and fps) of the files when it is not precomputed
 
     Returns:
         video (Tensor[T, H, W, C]): the `T` video frames
@@ -60,7 +62,8 @@ class Kinetics400(VisionDataset):
         num_components=None,
         prob=None,
         randomise_superpixels=None, 
-        randomise_superpixels_range=None
+        randomise_superpixels_range=None,
+        num_workers=1
     ):
         super(Kinetics400, self).__init__(root)
         extensions = extensions
@@ -81,6 +84,7 @@ class Kinetics400(VisionDataset):
             step_between_clips,
             frame_rate,
             _precomputed_metadata,
+            num_workers=num_workers,
         )
 
         self.transform = transform
@@ -32,32 +32,24 @@ def compute_mask(video, sp_method, num_components, p,
     else:
         method = sp_method
 
-    if randomise_superpixels:
-        # Randomise the (max) number of segments in each frame over time
-        for t in range(video.shape[0]):
-            img = video[t, :, :, :]
-            img = img.permute(1, 2, 0).cpu().numpy()
-            if method == "slic":
+    # Move the clip to a contiguous numpy (T, h, w, c) array once, rather than frame by frame
+    frames = video.permute(0, 2, 3, 1).contiguous().cpu().numpy()
+
+    for img in frames:
+        if method == "slic":
+            if randomise_superpixels:
+                # Randomise the (max) number of segments in each frame over time
                 low, high = (num_components - randomise_superpixels_range//2, 
                              num_components + randomise_superpixels_range//2)
-                segments = compute_sp_slic(img, 
-                                           torch.randint(low=low, high=high, size=(1,)).item(), 
-                                           compactness)
-            elif method == "fh":
-                segments = compute_sp_FH(img)
-            sp_tensor_time.append(torch.from_numpy(segments))
-    else:
-        for t in range(video.shape[0]):
-            img = video[t, :, :, :]
-            img = img.permute(1, 2, 0).cpu().numpy()
-            if method == "slic":
-                segments = compute_sp_slic(img, num_components, compactness)
-            elif method == "fh":
-                segments = compute_sp_FH(img)
-            sp_tensor_time.append(torch.from_numpy(segments))
-
-    mask = torch.stack(sp_tensor_time)
-    mask = mask.unsqueeze(3).repeat(1, 1, 1, 3)
-    mask = mask.permute(0, 3, 1, 2)
+                n_segments = torch.randint(low=low, high=high, size=(1,)).item()
+            else:
+                n_segments = num_components
+            segments = compute_sp_slic(img, n_segments, compactness)
+        elif method == "fh":
+            segments = compute_sp_FH(img)
+        sp_tensor_time.append(torch.from_numpy(segments))
+
+    # Dense (T, h, w) label map; int16 comfortably holds the segment labels
+    mask = torch.stack(sp_tensor_time).to(torch.int16)
 
     return mask.numpy()
@@ -1,13 +1,12 @@
+import contextlib
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import numpy as np
 import utils
 
-import skimage
-from skimage.util import img_as_float
-
-from utils import ZeroSoftmax, view_as_windows
+from utils import ZeroSoftmax
 
 EPS = 1e-20
 
@@ -27,6 +26,7 @@ class CRW(nn.Module):
 
         self.xent = nn.CrossEntropyLoss(reduction="none")
         self._xent_targets = dict()
+        self._diag_masks = dict()
 
         self.dropout = nn.Dropout(p=self.edgedrop_rate, inplace=False)
         self.featdrop = nn.Dropout(p=self.featdrop_rate, inplace=False)
@@ -37,13 +37,34 @@ class CRW(nn.Module):
 
         self.dilation_kernel = utils.make_dilation_kernel(args) if args.dilate_superpixels else None
 
+        # Mixed precision for the encoder and affinities; walks and loss always stay in fp32
+        self.amp_dtype = {"fp16": torch.float16, "bf16": torch.bfloat16}.get(getattr(args, "amp", "none"))
+        if self.amp_dtype == torch.bfloat16:
+            assert hasattr(torch, "autocast"), "--amp bf16 requires PyTorch >= 1.10"
+
+        # Walks and loss are many small kernels on N x N matrices; optionally fuse them (PyTorch >= 2.0)
+        # NOTE compiled from the unbound method so DataParallel replicas pass their own self; no CUDA
+        # graphs (reduce-overhead) since N changes from batch to batch with superpixels
+        self._compiled_walk_losses = None
+        if getattr(args, "compile", False):
+            assert hasattr(torch, "compile"), "--compile requires PyTorch >= 2.0"
+            self._compiled_walk_losses = torch.compile(CRW.walk_losses, dynamic=None)
+
     def infer_dims(self):
         in_sz = 256
         dummy = torch.zeros(1, 3, 1, in_sz, in_sz).to(next(self.encoder.parameters()).device)
-        dummy_out = self.encoder(dummy)
+        with torch.no_grad():
+            dummy_out = self.encoder(dummy)
         self.enc_hid_dim = dummy_out.shape[1]
         self.map_scale = in_sz // dummy_out.shape[-1]
 
+    def autocast(self):
+        if self.amp_dtype is None:
+            return contextlib.nullcontext()
+        if self.amp_dtype == torch.float16:
+            return torch.cuda.amp.autocast()
+        return torch.autocast("cuda", dtype=self.amp_dtype)
+
     def make_head(self, depth=1):
         head = []
         if depth >= 0:
@@ -56,16 +77,20 @@ class CRW(nn.Module):
         return nn.Sequential(*head)
 
     def zeroout_diag(self, A, zero=0):
-        mask = (torch.eye(A.shape[-1]).unsqueeze(0).repeat(A.shape[0], 1, 1).bool() < 1)
-        mask = mask.float().cuda()
-        return A * mask
+        key = (A.device, A.shape[-1])
+
+        if key not in self._diag_masks:
+            self._diag_masks[key] = 1.0 - torch.eye(A.shape[-1], device=A.device)
+
+        return A * self._diag_masks[key]
 
     def affinity(self, x1, x2):
         in_t_dim = x1.ndim
         if in_t_dim < 4:  # add in time dimension if not there
             x1, x2 = x1.unsqueeze(-2), x2.unsqueeze(-2)
 
-        A = torch.einsum("bctn,bctm->btnm", x1, x2)
+        # bctn,bctm->btnm as a batched matmul, (B, T, N, C) @ (B, T, C, M)
+        A = torch.matmul(x1.permute(0, 2, 3, 1), x2.permute(0, 2, 1, 3))
         # if self.restrict is not None:
         #     A = self.restrict(A)
 
@@ -78,7 +103,7 @@ class CRW(nn.Module):
             A = self.zeroout_diag(A)
 
         if do_dropout and self.edgedrop_rate > 0:
-            A[torch.rand_like(A) < self.edgedrop_rate] = -1e20
+            A = A.masked_fill(torch.empty_like(A).bernoulli_(self.edgedrop_rate).bool(), -1e20)
 
         if do_sinkhorn:
             return utils.sinkhorn_knopp((A / self.temperature).exp(),
@@ -112,12 +137,13 @@ class CRW(nn.Module):
             maps = maps.view(-1, *maps.shape[3:])[..., None, None]
             N, H, W = maps.shape[0] // B, 1, 1
 
-        # compute node embeddings by spatially pooling node feature maps
-        feats = maps.sum(-1).sum(-1) / (H * W)
-        feats = self.selfsim_fc(feats.transpose(-1, -2)).transpose(-1, -2)
-        feats = F.normalize(feats, p=2, dim=1)
+        # compute node embeddings by spatially pooling node feature maps; B*N x T x C
+        feats = maps.mean(dim=(-2, -1)).transpose(-1, -2)
+        feats = self.selfsim_fc(feats)
+        feats = utils.l2_normalize(feats, dim=-1)
 
-        feats = feats.view(B, N, feats.shape[1], T).permute(0, 2, 3, 1)
+        # (B*N, T, C) -> (B, C, T, N) as a view; channels stay innermost, as affinity wants them
+        feats = feats.view(B, N, T, feats.shape[-1]).permute(0, 3, 2, 1)
         maps = maps.view(B, N, *maps.shape[1:])
 
         return feats, maps
@@ -126,130 +152,31 @@ class CRW(nn.Module):
     # CPU Superpixel functions - Retained for reference
     ############################################################
 
-    def extract_sp_feat_cpu(self, img, img_maps, sp_mask):
-        """
-        img has shape of c, T, h, w
-        img_maps has shape of C, T, H, W
-        sp_mask has shape of T, h, w
-        """
-
-        c, T, h, w = img.shape
-        C, T, H, W = img_maps.shape
-
-        final_feats = []
-        final_segment = []
-
-        for t in range(T):
-
-            device = "cuda" if torch.cuda.is_available() else "cpu"
-
-            img_map = img_maps[:, t, :, :].permute(1, 2, 0)
-            # New shape is: (H, W, C) = (32, 32, 512)
-
-            segments = sp_mask[t, :, :]  # Shape is: (h, w) = (256, 256)
-
-            # Compute mask for each superpixel
-            sp_tensor = []
-
-            for sp in torch.unique(segments):
-                # Select specific SP
-                single_sp = (segments == sp) * 1
-                sp_tensor.append(single_sp)
-
-            # This has shape: (num_sp, h, w) = (~50, 256, 256)
-            sp_tensor = torch.stack(sp_tensor).cpu().numpy()
-
-            # Compute receptive fields relative to each superpixel mask
-            out = skimage.util.view_as_windows(
-                sp_tensor, (sp_tensor.shape[0], int(h / H), int(w / W)), step=int(h / H)
-            ).squeeze(0)
-            # This should have as shape (num_windows, num_windows, num_sp, window_size, window_size) = (32,32,~50,8,8)
-
-            # Extract features weight as normalized interesction of sp mask and receptive field of each features
-            # size of superpixels for each receptive field - shape is (num_windows, num_windows, num_sp) = (32,32,~50)
-            ww_not_norm = torch.sum(
-                torch.sum(torch.from_numpy(out).to(device), dim=-1), dim=-1
-            )
-            # Size of each superpixel - shape is num_sp = = (~50)
-            sp_size = torch.sum(
-                torch.sum(torch.from_numpy(sp_tensor).to(device), dim=-1), dim=-1
-            )
-            ww_norm = ww_not_norm / sp_size
-
-            # Expand correctly weights and features map to use tensor instead of for loop
-            # Shape is: (num_windows, num_windows, C, num_sp) = (32,32,512,~50)
-            ww_norm_expand = ww_norm.unsqueeze(2).repeat(1, 1, C, 1)
-            # Shape is: (num_feat, num_feat, C, num_sp) = (32,32,512,~50)
-            img_map_expand = img_map.unsqueeze(-1).repeat(
-                1, 1, 1, ww_norm_expand.shape[-1]
-            )
-            # Please note num_windows and num_feat are the same.
-            # So we repeat weights for each feature channels and feat for each superpixels, because they are independent
-
-            # Weighted mean of the features
-            oo = ww_norm_expand * img_map_expand
-            feats = torch.sum(torch.sum(oo, 0), 0).permute(
-                1, 0)  # Shape is: (~50, 512)
-
-            final_feats.append(feats)
-
-        return final_feats, final_segment
-
     def image_to_nodes_cpu(self, x, sp_mask, max_sp_num):
         """Inputs:
-            -- 'x' (B x C x T x h x w), batch of images
+            -- 'x' (B x T x c x h x w), batch of images
+            -- 'sp_mask' (B x T x h x w), dense superpixel mask; integers 0, ..., (max_sp_num-1)
         Outputs:
             -- 'feats' (B x C x T x N), node embeddings
-            -- 'maps'  (B x C x T x H x W), node feature maps
+            -- 'seg_list' (list of B empty lists), placeholder kept from the per-frame implementation,
+               which returned per-frame segments here; nothing is computed for it
         """
 
         B, T, c, h, w = x.shape
         x = x.permute(0, 2, 1, 3, 4)  # New shape B, c, T, h, w
         maps = self.encoder(x)
-        B, C, T, H, W = maps.shape
-        N = max_sp_num
 
         if self.featdrop_rate > 0:
             maps = self.featdrop(maps)
 
-        ff_list = []
-        seg_list = []
-
-        for b in range(B):
-            ff, seg = self.extract_sp_feat_cpu(
-                x[b], maps[b], sp_mask[b, :, 0, :, :])
-
-            ff_list.append(ff)
-            seg_list.append(seg)
-
-        ff_tensor = torch.empty(
-            (0, T, max_sp_num, C), requires_grad=True, device="cuda"
-        )
-
-        for ff in ff_list:
-            ff_time_tensor = torch.empty(
-                (0, max_sp_num, C), requires_grad=True, device="cuda"
-            )
-
-            for sp_feats in ff:
-                temp_sp_feats = nn.functional.pad(
-                    sp_feats,
-                    pad=(0, 0, 0, max_sp_num - sp_feats.shape[0]),
-                    mode="constant",
-                ).unsqueeze(0)
-                ff_time_tensor = torch.cat(
-                    (ff_time_tensor, temp_sp_feats), dim=0)
-
-            ff_tensor = torch.cat(
-                (ff_tensor, ff_time_tensor.unsqueeze(0)), dim=0)
-
-        # compute frame embeddings by spatially pooling frame feature maps
-        # shape (B,T,SP,C) -> (B,SP,C,T)
-        ff_tensor = ff_tensor.permute(0, 2, 3, 1)
-        ff_tensor = self.selfsim_fc(
-            ff_tensor.transpose(-1, -2)).transpose(-1, -2)
-        ff_tensor = F.normalize(ff_tensor, p=2, dim=2)
-        ff_tensor = ff_tensor.permute(0, 2, 3, 1)  # B, C, T, SP
+        # Superpixel pooling of the whole batch at once; shape (B,T,SP,C)
+        ff_tensor = self.extract_sp_feat_batched(maps, sp_mask, max_sp_num)
+        seg_list = [[] for _ in range(B)]
+
+        # project and normalise the (B,T,SP,C) superpixel features channels-last, as image_to_nodes
+        ff_tensor = self.selfsim_fc(ff_tensor)
+        ff_tensor = utils.l2_normalize(ff_tensor, dim=3)
+        ff_tensor = ff_tensor.permute(0, 3, 1, 2)  # B, C, T, SP
 
         return ff_tensor, seg_list
 
@@ -257,6 +184,47 @@ class CRW(nn.Module):
     # Parallelised (GPU) Superpixels
     ############################################################
 
+    def extract_sp_feat_batched(self, maps, sp_mask, max_sp_num):
+        """
+        Superpixel pooling: average frame feature maps within each superpixel, weighting every
+        feature by the fraction of the superpixel that falls in its receptive field.
+
+        Inputs:
+            -- 'maps' (B x C x T x H x W), video (frame) feature maps
+            -- 'sp_mask' (B x T x h x w), dense superpixel mask; integers 0, ..., (max_sp_num-1)
+            -- 'max_sp_num' (int), maximum number of superpixels used (value passed to segmentation algo)
+        Outputs:
+            -- 'sp_feats' (B x T x max_sp_num x C), superpixel features
+        """
+        B, C, T, H, W = maps.shape
+        kh, kw = sp_mask.shape[-2] // H, sp_mask.shape[-1] // W
+
+        # Group the superpixel label of every pixel by the receptive field (feature cell) it falls in;
+        # border pixels left over when h, w are not multiples of H, W are cropped (as view_as_windows did)
+        # Shape is: (B*T*H*W, window_size*window_size) = (B*T*32*32, 8*8)
+        segments = sp_mask[..., :H * kh, :W * kw].long().clamp(0, max_sp_num)
+        segments = segments.reshape(B, T, H, kh, W, kw).permute(0, 1, 2, 4, 3, 5)
+        segments = segments.reshape(B * T * H * W, -1)
+
+        # Count pixels of each superpixel inside each receptive field via scatter, without
+        # materialising the (SP, h, w) one-hot masks. Out of range labels land in the
+        # extra last column and are dropped.
+        # Shape is: (B, T, H, W, SP)
+        # NOTE counts and sizes in fp32 even under autocast; fp16 is not exact past 2048 pixels
+        ww = torch.zeros(B * T * H * W, max_sp_num + 1, device=maps.device, dtype=torch.float)
+        ww.scatter_add_(1, segments, torch.ones_like(segments, dtype=torch.float))
+        ww = ww[:, :max_sp_num].view(B, T, H, W, max_sp_num)
+
+        # Normalise by superpixel sizes, counted over the whole (uncropped) mask as in the
+        # dilated branch of image_to_nodes
+        labels = sp_mask.long().clamp(0, max_sp_num).view(B * T, -1)
+        sizes = torch.zeros(B * T, max_sp_num + 1, device=maps.device, dtype=torch.float)
+        sizes.scatter_add_(1, labels, torch.ones_like(labels, dtype=torch.float))
+        ww = ww / (sizes[:, :max_sp_num].view(B, T, 1, 1, max_sp_num) + EPS)
+
+        # Weighted mean of the features; shape (B, T, SP, C)
+        return torch.einsum("bcthw,bthws->btsc", maps, ww)
+
     def image_to_nodes(self, x, sp_mask, max_sp_num):
         """ 
         Compute superpixel node representations by spatially average pooling feature maps within 
@@ -266,7 +234,7 @@ class CRW(nn.Module):
 
         Inputs:
             -- 'x' (B x T x c x h x w), video (frame image sequence)
-            -- 'sp_mask' (B x T x c x h x w), dense superpixel maks; integers 0, ..., (max_sp_num-1)
+            -- 'sp_mask' (B x T x h x w), dense superpixel mask; integers 0, ..., (max_sp_num-1)
             -- 'max_sp_num' (int), maximum number of superpixels used (value passed to segmentation algo)
         Outputs:
             # -- 'sp_feats' (B x C_reduced x T x N), superpixel node embeddings
@@ -293,41 +261,38 @@ class CRW(nn.Module):
         # Number of superpixels present in each mask; (B, T); (8, 4). Useful for downstream checks
         # n_superpixels = torch.max(sp_mask.flatten(2,3), dim=2)[0]
 
-        # Make sp_mask "one-hot" from dense, with a new SP dimension;  B, T, SP, h, w
-        # NOTE Segmentation (e.g. SLIC) returns a 3-channel mask
-        sp_mask = sp_mask[:, :, 0, :, :]
-        idxs_sp = torch.arange(max_sp_num, device=self.args.device)[None, :, None, None]
-        # NOTE sp_mask broadcasts over SP dimension
-        sp_mask = (sp_mask.unsqueeze(2) == idxs_sp).int()
+        if self.dilation_kernel is None:
+            sp_feats = self.extract_sp_feat_batched(maps, sp_mask, max_sp_num)
+        else:
+            # Dilated superpixels overlap, so pool with (dense) one-hot masks instead
+            # Make sp_mask "one-hot" from dense, with a new SP dimension;  B, T, SP, h, w
+            # Scattered straight into a contiguous half precision buffer, the dtype the dilation conv uses
+            # NOTE labels >= max_sp_num scatter a 0, i.e. are dropped
+            labels = sp_mask.long().unsqueeze(2)
+            sp_mask = torch.zeros(B, T, max_sp_num, h, w, device=labels.device, dtype=torch.float16)
+            sp_mask.scatter_(2, labels.clamp(0, max_sp_num - 1), (labels < max_sp_num).to(torch.float16))
 
-        if self.dilation_kernel is not None:
             B, T, SP, h, w = sp_mask.shape
             padding = self.args.dilation_kernel_size // 2
-            sp_mask = sp_mask.flatten(1, 2).to(torch.float16)
+            sp_mask = sp_mask.flatten(1, 2)
             kernel = self.dilation_kernel.repeat(T*SP, 1, 1).unsqueeze(1) # out_chan, in_chan/groups 
             sp_mask = (F.conv2d(sp_mask, weight = kernel, padding=padding, groups=T*SP) > 0).int()
             sp_mask = sp_mask.view(B, T, SP, h, w)
 
-        # Create a weighted superpixel mask to apply to feature maps
-        # NOTE window_shape is (B, T, SP, h//H, w//W)
-        window_shape, window_step = (*sp_mask.shape[:3], h//H, w//W), h // H
-        sp_mask_wndws = view_as_windows(sp_mask, window_shape, step=window_step)[0, 0, 0]  # drop singleton dims
-        # sum over windows h//H and w//W
-        sp_mask_wndws = sp_mask_wndws.sum(-1).sum(-1)
-        # (H, W, B, T, SP) -> (B, T, H, W, SP)
-        sp_mask_wndws = sp_mask_wndws.permute(2, 3, 0, 1, 4)
-        sp_mask_wndws = sp_mask_wndws / (sp_mask.sum(-1).sum(-1) + EPS)[:, :, None, None, :]  # normalise mask by SP sizes
-        sp_mask_wndws = sp_mask_wndws.unsqueeze(4)
-
-        # Compute superpixel node embeddings by multiplying feature maps by weighted mask
-        img_map_expanded = maps.permute(0, 2, 3, 4, 1).unsqueeze(-1)
-        sp_feats = sp_mask_wndws * img_map_expanded
-        sp_feats = sp_feats.sum(2).sum(2).permute(0, 3, 1, 2)
+            # Create a weighted superpixel mask to apply to feature maps
+            # Strided (h//H, w//W) windows of the mask as a view; (B, T, SP, H, W, h//H, w//W)
+            sp_mask_wndws = sp_mask.unfold(3, h // H, h // H).unfold(4, w // W, w // W)
+            # sum over windows h//H and w//W; (B, T, SP, H, W)
+            sp_mask_wndws = sp_mask_wndws.sum(dim=(-2, -1))
+            sp_mask_wndws = sp_mask_wndws / (sp_mask.sum(dim=(-2, -1)) + EPS)[..., None, None]  # normalise mask by SP sizes
+
+            # Compute superpixel node embeddings as weighted mean of feature maps; B, T, SP, C
+            sp_feats = torch.einsum("bcthw,btshw->btsc", maps, sp_mask_wndws.float())
 
         # Reduce latent dimensionality of superpixel nodes via projection head
         sp_feats = self.selfsim_fc(sp_feats)
-        sp_feats = F.normalize(sp_feats, p=2, dim=3)
-        sp_feats = sp_feats.permute(0, 3, 2, 1)  # B, C, T, SP
+        sp_feats = utils.l2_normalize(sp_feats, dim=3)
+        sp_feats = sp_feats.permute(0, 3, 1, 2)  # B, C, T, SP
 
         return sp_feats, maps
 
@@ -339,50 +304,43 @@ class CRW(nn.Module):
         """
         B, T, C, H, W = x.shape
 
-        #################################################################
-        # Image/Pixels to Nodes
-        #################################################################
+        with self.autocast():
+            #################################################################
+            # Image/Pixels to Nodes
+            #################################################################
 
-        if sp_mask is None:
-            # Patches
-            _N, C = C // 3, 3
-            x = x.transpose(1, 2).view(B, _N, C, T, H, W)
-            q, mm = self.pixels_to_nodes(x)
-        else:
-            # Superpixels
-            q, mm = self.image_to_nodes(x, sp_mask, max_sp_num)
+            if sp_mask is None:
+                # Patches
+                _N, C = C // 3, 3
+                x = x.transpose(1, 2).view(B, _N, C, T, H, W)
+                q, mm = self.pixels_to_nodes(x)
+            else:
+                # Superpixels
+                q, mm = self.image_to_nodes(x, sp_mask, max_sp_num)
+
+            B, C, T, N = q.shape
 
-        B, C, T, N = q.shape
+            if just_feats:
+                h, w = np.ceil(
+                    np.array(x.shape[-2:]) / self.map_scale).astype(np.int)
+                return (q, mm) if _N > 1 else (q, q.view(*q.shape[:-1], h, w))
 
-        if just_feats:
-            h, w = np.ceil(
-                np.array(x.shape[-2:]) / self.map_scale).astype(np.int)
-            return (q, mm) if _N > 1 else (q, q.view(*q.shape[:-1], h, w))
+            As = self.affinity(q[:, :, :-1], q[:, :, 1:])
 
         #################################################################
         # Compute walks
         #################################################################
 
-        walks = dict()
-
-        As = self.affinity(q[:, :, :-1], q[:, :, 1:])
-        A12s = [self.stoch_mat(As[:, i], do_dropout=True)
-                for i in range(T - 1)]
-
-        # Palindromes
-        A21s = [self.stoch_mat(As[:, i].transpose(-1, -2),
-                               do_dropout=True) for i in range(T - 1)]
-        AAs = []
-        for i in list(range(1, len(A12s))):
-            g = A12s[: i + 1] + A21s[: i + 1][::-1]
-            aar = aal = g[0]
-            for _a in g[1:]:
-                aar, aal = aar @ _a, _a @ aal
-
-            AAs.append((f"l{i}", aal) if self.flip else (f"r{i}", aar))
-
-        for i, aa in AAs:
-            walks[f"cyc {i}"] = [aa, self.xent_targets(aa)]
+        # NOTE in fp32: the exponentials of stoch_mat and the long matrix products overflow/drift in half
+        As = As.float()
+        if self._compiled_walk_losses is not None:
+            # N (number of nodes) varies per batch; trace it symbolically rather than recompiling
+            torch._dynamo.mark_dynamic(As, 2)
+            torch._dynamo.mark_dynamic(As, 3)
+            A12s, losses, accs = self._compiled_walk_losses(self, As)
+        else:
+            A12s, losses, accs = self.walk_losses(As)
+        walks = [f"cyc {'l' if self.flip else 'r'}{i}" for i in range(1, T - 1)]
 
         #################################################################
         # Compute loss
@@ -391,10 +349,7 @@ class CRW(nn.Module):
         xents = [torch.tensor([0.0]).to(self.args.device)]
         diags = dict()
 
-        for name, (A, target) in walks.items():
-            logits = torch.log(A + EPS).flatten(0, -2)
-            loss = self.xent(logits, target).mean()
-            acc = (torch.argmax(logits, dim=-1) == target).float().mean()
+        for name, loss, acc in zip(walks, losses, accs):
             diags.update({f"{H} xent {name}": loss.detach(),
                           f"{H} acc {name}": acc})
             xents += [loss]
@@ -406,7 +361,7 @@ class CRW(nn.Module):
             with torch.no_grad():
                 vid = x[0].cpu().detach().numpy()
                 mask = sp_mask[0].cpu().detach().numpy()
-                A12s_vis = torch.stack(A12s)[:, 0, :, :].cpu().detach().numpy()
+                A12s_vis = A12s[:, 0, :, :].cpu().detach().numpy()
                 utils.visualize.vis_adj(
                     vid, mask, A12s_vis, self.vis.vis, orig_unnorm[0].cpu().detach().numpy())
 
@@ -414,13 +369,47 @@ class CRW(nn.Module):
 
         return q, loss, diags
 
+    def walk_losses(self, As):
+        """
+        Affinities -> palindrome (cycle) walks -> per-walk cross-entropy loss and accuracy
+
+        Inputs:
+            -- 'As' (B x T-1 x N x N), affinities between consecutive frames
+        Outputs:
+            -- 'A12s' (T-1 x B x N x N), forward transition matrices
+            -- 'losses' (T-2), cross-entropy of each cycle walk
+            -- 'accs' (T-2), accuracy of each cycle walk
+        """
+        # Forward (A12s) and backward (A21s) transitions in a single call, i.e. one dropout mask
+        # and one softmax; each is T-1 x B x N x N
+        A12s, A21s = self.stoch_mat(torch.stack([As, As.transpose(-1, -2)]).transpose(1, 2),
+                                    do_dropout=True)
+
+        # Palindromes
+        # Walk i is A12s[0] @ ... @ A12s[i] @ A21s[i] @ ... @ A21s[0] (roles swapped if flipped),
+        # so all walks follow from the prefix products of A12s and of the transposed A21s
+        fwd, bwd = (A21s, A12s) if self.flip else (A12s, A21s)
+        bwd = bwd.transpose(-1, -2)
+        prods = utils.cumulative_matmul(torch.stack([fwd, bwd], dim=1))  # T-1, 2, B, N, N
+        AAs = prods[1:, 0] @ prods[1:, 1].transpose(-1, -2)  # T-2, B, N, N
+
+        # All walks in one batched loss
+        # NOTE cross-entropy rather than nll of the log: the two agree on stochastic rows, but the
+        # all-zero rows of empty (padded) superpixel nodes must cost log N, not -log EPS
+        W, B, N = AAs.shape[:3]
+        logits = torch.log(AAs.clamp_min(EPS)).flatten(0, -2)
+        target = self.xent_targets(AAs.flatten(0, 1))
+        losses = self.xent(logits, target).view(W, B * N).mean(-1)
+        accs = (torch.argmax(logits, dim=-1) == target).float().view(W, B * N).mean(-1)
+
+        return A12s, losses, accs
+
     def xent_targets(self, A):
         B, N = A.shape[:2]
-        key = "%s:%sx%s" % (str(A.device), B, N)
+        key = (A.device, B, N)
 
         if key not in self._xent_targets:
-            I = torch.arange(A.shape[-1])[None].repeat(B, 1)
-            self._xent_targets[key] = I.view(-1).to(A.device)
+            self._xent_targets[key] = torch.arange(A.shape[-1], device=A.device).repeat(B)
 
         return self._xent_targets[key]
 
@@ -34,7 +34,8 @@ class CRWBase(nn.Module):
     def infer_dims(self):
         in_sz = 256
         dummy = torch.zeros(1, 3, 1, in_sz, in_sz).to(next(self.encoder.parameters()).device)
-        dummy_out = self.encoder(dummy)
+        with torch.no_grad():
+            dummy_out = self.encoder(dummy)
         self.enc_hid_dim = dummy_out.shape[1]
         self.map_scale = in_sz // dummy_out.shape[-1]
 
@@ -103,7 +104,7 @@ class CRWBase(nn.Module):
             N, H, W = maps.shape[0] // B, 1, 1
 
         # compute node embeddings by spatially pooling node feature maps
-        feats = maps.sum(-1).sum(-1) / (H*W)
+        feats = maps.mean(dim=(-2, -1))
         feats = self.selfsim_fc(feats.transpose(-1, -2)).transpose(-1,-2)
         feats = F.normalize(feats, p=2, dim=1)
     
@@ -343,7 +344,8 @@ class CRWTeacherStudent(nn.Module):
     def infer_dims(self):
         in_sz = 256
         dummy = torch.zeros(1, 3, 1, in_sz, in_sz).to(next(self.encoder.parameters()).device)
-        dummy_out = self.encoder(dummy)
+        with torch.no_grad():
+            dummy_out = self.encoder(dummy)
         self.enc_hid_dim = dummy_out.shape[1]
         self.map_scale = in_sz // dummy_out.shape[-1]
 
@@ -424,7 +426,7 @@ class CRWTeacherStudent(nn.Module):
             N, H, W = maps.shape[0] // B, 1, 1
 
         # compute node embeddings by spatially pooling node feature maps
-        feats = maps.sum(-1).sum(-1) / (H*W)
+        feats = maps.mean(dim=(-2, -1))
         feats = self.selfsim_fc(feats.transpose(-1, -2)).transpose(-1,-2)
         feats = F.normalize(feats, p=2, dim=1)
     
@@ -460,7 +462,7 @@ class CRWTeacherStudent(nn.Module):
             N, H, W = maps.shape[0] // B, 1, 1
 
         # compute node embeddings by spatially pooling node feature maps
-        feats = maps.sum(-1).sum(-1) / (H*W)
+        feats = maps.mean(dim=(-2, -1))
         feats = self.teacher.selfsim_fc(feats.transpose(-1, -2)).transpose(-1,-2)
         feats = F.normalize(feats, p=2, dim=1)
     
@@ -485,8 +487,9 @@ class CRWTeacherStudent(nn.Module):
         q, mm = self.pixels_to_nodes(x)
         B, C, T, N = q.shape
 
-        # Teacher features and maps
-        q_tchr, mm_tchr = self.pixels_to_nodes_tchr(x)
+        # Teacher features and maps; the teacher is frozen so keep its encoder pass out of autograd
+        with torch.no_grad():
+            q_tchr, mm_tchr = self.pixels_to_nodes_tchr(x)
 
         # Commented: Not used - Implement as needed
         # if just_feats:
@@ -35,7 +35,7 @@ torch.autograd.set_detect_anomaly(True)
 
 def train_one_epoch(model, optimizer, lr_scheduler, data_loader, device,
                     epoch, print_freq, vis=None, checkpoint_fn=None, 
-                    prob=None):
+                    prob=None, scaler=None):
 
     model.train()
     metric_logger = utils.MetricLogger(delimiter="  ")
@@ -57,9 +57,11 @@ def train_one_epoch(model, optimizer, lr_scheduler, data_loader, device,
             video = video.to(device)
             output, loss, diagnostics = model(video, None, None, orig_unnorm=None) if not args.teacher_student else model(video)
         else:
+            # Number of superpixel nodes from the largest label, on the host copy of the mask
+            # (avoids a device-side sort and sync for torch.unique)
+            max_sp_num = int(sp_mask.max()) + 1
             sp_mask = sp_mask.to(device)
             orig = orig.to(device)
-            max_sp_num = len(torch.unique(sp_mask))
             output, loss, diagnostics = model(orig, 
                                               sp_mask, 
                                               max_sp_num, 
@@ -77,8 +79,14 @@ def train_one_epoch(model, optimizer, lr_scheduler, data_loader, device,
             checkpoint_fn()
 
         optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
+        if scaler is not None:
+            # fp16 mixed precision; scale the loss so small gradients do not underflow
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
+        else:
+            loss.backward()
+            optimizer.step()
 
         metric_logger.update(loss=loss.item(), lr=optimizer.param_groups[0]["lr"])
         metric_logger.meters['clips/s'].update(video.shape[0] / (time.time() - start_time))
@@ -110,6 +118,7 @@ def train_one_epoch(model, optimizer, lr_scheduler, data_loader, device,
 # Minor functions
 # - _get_cache_path : get cache path for automatic caching of train dataset
 # - collate_fn      : custom collate function for dataloader; removes audio from data samples
+# - check_amp       : sanity check that mixed precision gives a finite superpixel loss
 ####################################################################################################
 
 
@@ -126,6 +135,19 @@ def collate_fn(batch):
     batch = [(d[0], d[1]) for d in batch]
     return default_collate(batch)
 
+
+def check_amp(model, args, device):
+    # Superpixel batch where label 1 is unused, so its (and the padded) nodes pool to zero
+    # vectors; under fp16 autocast these used to give a NaN loss
+    orig = torch.rand(2, args.clip_len, 3, args.img_size, args.img_size, device=device)
+    sp_mask = torch.zeros(2, args.clip_len, args.img_size, args.img_size, dtype=torch.int16)
+    sp_mask[..., args.img_size // 2:, :] = 2
+    model.eval()
+    with torch.no_grad():
+        _, loss, _ = model(orig, sp_mask.to(device), int(sp_mask.max()) + 2)
+    model.train()
+    assert torch.isfinite(loss).all(), f"Non-finite loss on a superpixel batch with unused labels under --amp {args.amp}"
+
 ####################################################################################################
 # Main
 ####################################################################################################
@@ -135,6 +157,7 @@ def main(args):
     # Eager Checks
     if args.teacher_student:
         assert args.prob == 1, "Teacher-Student training is not yet compatible with probabistic sp | patch sampling"
+        assert args.amp == 'none', "Teacher-Student training does not support mixed precision (--amp)"
 
     print("Arguments", end="\n" + "-"*100 + "\n")
     for arg, value in vars(args).items():
@@ -173,7 +196,8 @@ def main(args):
                 num_components=args.num_sp,
                 prob=args.prob,
                 randomise_superpixels=args.randomise_superpixels,
-                randomise_superpixels_range=args.randomise_superpixels_range
+                randomise_superpixels_range=args.randomise_superpixels_range,
+                num_workers=args.workers
             )
         # HACK assume image dataset if data path is a directory
         elif os.path.isdir(args.data_path):
@@ -288,6 +312,11 @@ def main(args):
             torch.save(checkpoint, os.path.join(args.output_dir, f'model_{epoch}.pth'))
             torch.save(checkpoint, os.path.join(args.output_dir, 'checkpoint.pth'))
 
+    # Gradient scaler for fp16 mixed precision
+    scaler = torch.cuda.amp.GradScaler() if args.amp == 'fp16' else None
+    if args.amp != 'none':
+        check_amp(model, args, device)
+
     # Start Training
     print("Start training", end="\n"+"-"*100+"\n")
     start_time = time.time()
@@ -295,7 +324,7 @@ def main(args):
         train_one_epoch(model, optimizer, lr_scheduler, data_loader,
                         device, epoch, args.print_freq,
                         vis=vis, checkpoint_fn=save_model_checkpoint,
-                        prob=args.prob)
+                        prob=args.prob, scaler=scaler)
 
     total_time = time.time() - start_time
     total_time_str = str(datetime.timedelta(seconds=int(total_time)))
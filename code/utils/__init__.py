@@ -616,9 +616,9 @@ def sinkhorn_knopp(A, tol=0.01, max_iter=1000, verbose=False):
     _iter = 0
 
     if A.ndim > 2:
-        A = A / A.sum(-1).sum(-1)[:, None, None]
+        A = A / A.sum(dim=(-2, -1))[:, None, None]
     else:
-        A = A / A.sum(-1).sum(-1)[None, None]
+        A = A / A.sum(dim=(-2, -1))[None, None]
 
     A1 = A2 = A
 
@@ -639,6 +639,31 @@ def sinkhorn_knopp(A, tol=0.01, max_iter=1000, verbose=False):
     return A2
 
 
+def cumulative_matmul(A):
+    """Prefix products of a stack of matrices along the first dimension, i.e.
+    out[k] = A[0] @ A[1] @ ... @ A[k]
+
+    Uses a (Hillis-Steele) parallel scan: log2(K) levels, each a single batched matmul,
+    instead of K sequential small matmuls.
+    """
+    K, step = A.shape[0], 1
+    while step < K:
+        A = torch.cat([A[:step], A[:-step] @ A[step:]])
+        step *= 2
+
+    return A
+
+
+def l2_normalize(x, dim=-1, eps=1e-12):
+    """Same as F.normalize(x, p=2, dim=dim, eps=eps), as a single multiply by the reciprocal
+    norm, so the scaling is one elementwise kernel (fusable with the preceding op under
+    torch.compile). Computed in fp32 and cast back, since under autocast fp16 both x * x and
+    the reciprocal norm of a zero vector (1 / eps) overflow.
+    """
+    xf = x.float()
+    return (xf * torch.rsqrt((xf * xf).sum(dim, keepdim=True).clamp_min(eps * eps))).to(x.dtype)
+
+
 def to_numpy(tensor):
     if torch.is_tensor(tensor):
         return tensor.cpu().numpy()
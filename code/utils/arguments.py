@@ -187,6 +187,10 @@ def train_args():
     parser.add_argument('--visualize', default=False,
                         action='store_true', help='visualize with wandb and visdom')
     parser.add_argument('--remove-layers', default=[], help='layer[1-4]')
+    parser.add_argument('--compile', default=False, action='store_true',
+                        help='torch.compile the walks and loss computation (requires PyTorch >= 2.0)')
+    parser.add_argument('--amp', default='none', type=str, choices=['none', 'fp16', 'bf16'],
+                        help='none | fp16 | bf16; mixed precision for encoder and affinities (bf16 requires PyTorch >= 1.10)')
 
     # Sinkhorn-Knopp Ideas (Experimental)
     parser.add_argument('--sk-align', default=False, action='store_true',
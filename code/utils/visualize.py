@@ -306,7 +306,7 @@ def vis_adj(video, sp_mask, As, viz, orig_unnorm):
         img = orig_unnorm[t]
         img = cv2.normalize(img, None, 0, 255, cv2.NORM_MINMAX, cv2.CV_8U)
         # img = video[t]
-        seg = sp_mask[t, 0]
+        seg = sp_mask[t]
 
         X = []
         Y = []